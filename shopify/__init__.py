@@ -1,13 +1,3 @@
-import logging
 from shopify.utils import load_env
 
 load_env()
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
-
-logger = logging.getLogger(__name__)
-logger.info("Shopify module initialized.")
@@ -1,17 +1,35 @@
 import os
+import re
 import json
+import random
+import asyncio
 import logging
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
+from shopify.limiter import AsyncLeakyBucket
 
 logger = logging.getLogger(__name__)
 
+IMPORT_PATTERN = re.compile(r'^#import\s+"([\w-]+)\.gql"\s*$', re.MULTILINE)
+
 
 class ShopifyGraphQL:
     API_VERSION = "2025-04"
     # ✅ Always store JSON responses in Club21OrderFeed/data/
     DESTINATION = Path(__file__).resolve().parent.parent / "data"
+    MAX_RETRIES = 5
+    DEFAULT_QUERY_COST = 10.0
+    # Shopify rejects any single query whose requested cost exceeds this
+    MAX_QUERY_COST = 1000.0
+    # Aliased order_details batches are sized so this many fit under the limiter's high-water mark at once
+    ORDER_DETAILS_BATCHES_IN_FLIGHT = 4
+    RESPONSE_CACHE_SIZE = 1024
 
     def __init__(self, api_key: str, store_name: str, query_path: Optional[str] = None):
         self.api_key = api_key
@@ -37,8 +55,44 @@ class ShopifyGraphQL:
             self.query_path = default
 
         self.DESTINATION.mkdir(parents=True, exist_ok=True)
+        self.limiter = AsyncLeakyBucket()
+        self._query_costs: Dict[str, float] = {}
+        self._query_cache: Dict[str, str] = {}
+        self._response_cache: OrderedDict[Tuple[str, bytes], bytes] = OrderedDict()
+        self._client: Optional[httpx.AsyncClient] = None
+
+        # Keep-alive pool for the sync fetch(); GraphQL reads are safe to retry on POST
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset({"POST"}),
+                raise_on_status=False,
+            ),
+        ))
+        self.session.headers.update(self.headers)
+
+    def __enter__(self) -> "ShopifyGraphQL":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.session.close()
+
+    async def __aenter__(self) -> "ShopifyGraphQL":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
 
     def load_query(self, query_name: str) -> str:
+        # Query files are static for the life of the process; read each one once
+        if query_name in self._query_cache:
+            return self._query_cache[query_name]
+
         query_file = self.query_path / f"{query_name}.gql"
         if not query_file.exists():
             logger.error(f"Query file {query_file} does not exist.")
@@ -47,6 +101,11 @@ class ShopifyGraphQL:
         with open(query_file, "r") as file:
             query = file.read()
 
+        # Append fragments referenced with `#import "<name>.gql"` lines
+        for fragment_name in IMPORT_PATTERN.findall(query):
+            query += "\n" + self.load_query(fragment_name)
+
+        self._query_cache[query_name] = query
         return query
 
     def save_response(self, response: Dict[str, Any], filename: str) -> str:
@@ -55,30 +114,53 @@ class ShopifyGraphQL:
             raise ValueError("Empty response received.")
 
         file_path = self.DESTINATION / filename
-        with open(file_path, "w") as file:
-            json.dump(response, file, indent=4)
+        with open(file_path, "wb") as file:
+            file.write(orjson.dumps(response))
 
         logger.info(f"Response saved to {file_path}")
         return str(file_path)
 
-    def fetch(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        url = f"https://{self.store_name}.myshopify.com/admin/api/{self.API_VERSION}/graphql.json"
-        headers = {
+    @property
+    def url(self) -> str:
+        return f"https://{self.store_name}.myshopify.com/admin/api/{self.API_VERSION}/graphql.json"
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
             "Content-Type": "application/json",
+            "Accept-Encoding": "gzip",
             "X-Shopify-Access-Token": self.api_key,
         }
 
-        graphql_query = self.load_query(query)
-        payload = {"query": graphql_query}
+    def build_payload(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        payload = {"query": self.load_query(query)}
         if variables:
             payload["variables"] = variables
+        return payload
+
+    def fetch(
+        self,
+        query: str,
+        variables: Optional[Dict[str, Any]] = None,
+        use_cache: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Run a query synchronously. With `use_cache`, a response already fetched for the same
+        query and variables is decoded from an in-process LRU of response bodies instead of
+        hitting Shopify (each call gets its own dict); only use it for lookups that may be
+        served stale (never for newest_order/orders polling).
+        """
+        cache_key = None
+        if use_cache:
+            cache_key = (query, orjson.dumps(variables, option=orjson.OPT_SORT_KEYS))
+            if cache_key in self._response_cache:
+                self._response_cache.move_to_end(cache_key)
+                return orjson.loads(self._response_cache[cache_key])
+
+        payload = self.build_payload(query, variables)
 
         try:
-            response = requests.post(
-                url=url,
-                headers=headers,
-                json=payload
-            )
+            response = self.session.post(self.url, json=payload, timeout=(5, 30))
 
             response.raise_for_status()
             data = response.json()
@@ -87,6 +169,11 @@ class ShopifyGraphQL:
                 logger.error(f"GraphQL errors: {data['errors']}")
                 raise ValueError(f"GraphQL errors: {data['errors']}")
 
+            if cache_key is not None:
+                self._response_cache[cache_key] = response.content
+                if len(self._response_cache) > self.RESPONSE_CACHE_SIZE:
+                    self._response_cache.popitem(last=False)
+
             return data
 
         except requests.exceptions.RequestException as e:
@@ -95,3 +182,181 @@ class ShopifyGraphQL:
         except json.JSONDecodeError as e:
             logger.error(f"Failed to parse response: {str(e)}")
             raise ValueError(f"Invalid JSON response: {str(e)}")
+
+    def clear_response_cache(self) -> None:
+        self._response_cache.clear()
+
+    async def fetch_async(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        return await self.post_async(self.build_payload(query, variables), cost_key=query)
+
+    async def post_async(
+        self,
+        payload: Dict[str, Any],
+        cost_key: str,
+        estimated_cost: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        for attempt in range(self.MAX_RETRIES + 1):
+            if attempt:
+                await self._backoff(attempt - 1)
+
+            reservation = await self.limiter.acquire(
+                estimated_cost or self._query_costs.get(cost_key, self.DEFAULT_QUERY_COST)
+            )
+            actual_cost = 0.0
+            try:
+                response = await self.client.post(self.url, json=payload)
+                logger.debug(
+                    f"{cost_key}: HTTP {response.status_code}, "
+                    f"content-encoding={response.headers.get('content-encoding', 'identity')}, "
+                    f"{response.num_bytes_downloaded} bytes on the wire"
+                )
+                self.limiter.update_from_header(response.headers.get("X-Shopify-Shop-Api-Call-Limit"))
+                if response.status_code == 429 and attempt < self.MAX_RETRIES:
+                    continue
+
+                response.raise_for_status()
+                data = orjson.loads(response.content)
+                cost = data.get("extensions", {}).get("cost", {})
+                actual_cost = float(cost.get("actualQueryCost") or 0.0)
+            except httpx.HTTPError as e:
+                logger.error(f"Request failed: {str(e)}")
+                raise
+            except json.JSONDecodeError as e:
+                logger.error(f"Failed to parse response: {str(e)}")
+                raise ValueError(f"Invalid JSON response: {str(e)}")
+            finally:
+                # Swap the estimate for what Shopify charged; throttleStatus below re-syncs the level
+                self.limiter.release(reservation, actual_cost)
+
+            if cost.get("requestedQueryCost"):
+                self._query_costs[cost_key] = float(cost["requestedQueryCost"])
+            if cost.get("throttleStatus"):
+                self.limiter.update_from_throttle_status(cost["throttleStatus"])
+
+            if "errors" in data:
+                throttled = any(
+                    error.get("extensions", {}).get("code") == "THROTTLED" for error in data["errors"]
+                )
+                if throttled and attempt < self.MAX_RETRIES:
+                    continue
+
+                logger.error(f"GraphQL errors: {data['errors']}")
+                raise ValueError(f"GraphQL errors: {data['errors']}")
+
+            return data
+
+    async def _backoff(self, attempt: int) -> None:
+        delay = 2 ** attempt + random.random()
+        logger.warning(f"Throttled by Shopify, retrying in {delay:.2f}s (attempt {attempt + 1}/{self.MAX_RETRIES})")
+        await asyncio.sleep(delay)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # One HTTP/2 client per instance: concurrent requests multiplex over a single connection
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                headers=self.headers,
+                timeout=30,
+                limits=httpx.Limits(max_connections=20, keepalive_expiry=60),
+            )
+        return self._client
+
+    async def _close_client(self) -> None:
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    async def close(self) -> None:
+        await self._close_client()
+        self.session.close()
+
+    async def fetch_many(
+        self,
+        query: str,
+        variables_list: List[Dict[str, Any]],
+        concurrency: int = 8,
+    ) -> List[Dict[str, Any]]:
+        """
+        Run the same query once per variables dict over the shared HTTP/2 client,
+        with at most `concurrency` requests in flight. Results keep the input order.
+        """
+        sem = asyncio.Semaphore(concurrency)
+
+        async def bounded_fetch(variables: Dict[str, Any]) -> Dict[str, Any]:
+            async with sem:
+                return await self.fetch_async(query, variables)
+
+        tasks = [bounded_fetch(variables) for variables in variables_list]
+        return await asyncio.gather(*tasks)
+
+    def fetch_many_sync(
+        self,
+        query: str,
+        variables_list: List[Dict[str, Any]],
+        concurrency: int = 8,
+    ) -> List[Dict[str, Any]]:
+        """
+        Blocking wrapper around fetch_many() for callers without an event loop.
+        The async client is tied to the loop it was created in, so it is closed before returning.
+        """
+        async def run() -> List[Dict[str, Any]]:
+            try:
+                return await self.fetch_many(query, variables_list, concurrency)
+            finally:
+                await self._close_client()
+
+        return asyncio.run(run())
+
+    def build_order_details_batch(self, order_ids: List[str]) -> Dict[str, Any]:
+        variables = {f"id{i}": order_id for i, order_id in enumerate(order_ids)}
+        definitions = ", ".join(f"${name}: ID!" for name in variables)
+        fields = "\n".join(f"  o{i}: order(id: $id{i}) {{ ...OrderDetails }}" for i in range(len(order_ids)))
+        query = f"query GetOrderDetailsBatch({definitions}) {{\n{fields}\n}}\n\n{self.load_query('order_details_fragment')}"
+        return {"query": query, "variables": variables}
+
+    async def fetch_order_details(
+        self,
+        order_ids: List[str],
+        max_batch_size: int = 20,
+        concurrency: int = 8,
+    ) -> List[Dict[str, Any]]:
+        """
+        Fetch order details for many orders, several per HTTP request via aliased `order`
+        fields. The first order is fetched alone to learn its query cost, which caps the
+        batch size so ORDER_DETAILS_BATCHES_IN_FLIGHT batches fit in the rate limiter's
+        budget together (and each document stays under MAX_QUERY_COST). Each result is
+        shaped like a single `order_details` response and results keep the input order.
+        """
+        if not order_ids:
+            return []
+
+        results = [await self.fetch_async("order_details", {"id": order_ids[0]})]
+
+        order_cost = self._query_costs.get("order_details", self.DEFAULT_QUERY_COST)
+        budget = min(
+            self.MAX_QUERY_COST,
+            self.limiter.capacity * self.limiter.high_water / self.ORDER_DETAILS_BATCHES_IN_FLIGHT,
+        )
+        batch_size = max(1, min(max_batch_size, int(budget // order_cost)))
+        batches = [order_ids[i:i + batch_size] for i in range(1, len(order_ids), batch_size)]
+        logger.info(f"Fetching {len(order_ids) - 1} order details in {len(batches)} batches of up to {batch_size}")
+
+        sem = asyncio.Semaphore(concurrency)
+
+        async def bounded_fetch(batch: List[str]) -> List[Dict[str, Any]]:
+            async with sem:
+                if len(batch) == 1:
+                    return [await self.fetch_async("order_details", {"id": batch[0]})]
+
+                data = await self.post_async(
+                    self.build_order_details_batch(batch),
+                    cost_key=f"order_details_batch_{len(batch)}",
+                    estimated_cost=order_cost * len(batch),
+                )
+                return [{"data": {"order": data["data"][f"o{i}"]}} for i in range(len(batch))]
+
+        for batch_results in await asyncio.gather(*[bounded_fetch(batch) for batch in batches]):
+            results.extend(batch_results)
+
+        return results
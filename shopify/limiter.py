@@ -0,0 +1,107 @@
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLeakyBucket:
+    """
+    Client-side mirror of Shopify's leaky bucket.
+
+    Requests reserve their estimated cost with `acquire()` and only wait when the
+    bucket plus in-flight reservations would rise above `high_water` of its capacity.
+    `release()` swaps a reservation for the cost Shopify actually charged. The bucket
+    drains at `leak_rate` points per second and is re-synced from every response, either
+    from GraphQL `extensions.cost.throttleStatus` or the
+    `X-Shopify-Shop-Api-Call-Limit: used/max` header. Waiters wake as soon as a release
+    or re-sync frees room, instead of sleeping out the worst case.
+    """
+
+    def __init__(self, capacity: float = 1000.0, leak_rate: float = 50.0, high_water: float = 0.8):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.high_water = high_water
+        self.level = 0.0
+        self.reserved = 0.0
+        self._last_leak = time.monotonic()
+        self._changed: Optional[asyncio.Event] = None
+        self._changed_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _leak(self) -> None:
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self._last_leak) * self.leak_rate)
+        self._last_leak = now
+
+    def _changed_event(self) -> asyncio.Event:
+        # asyncio primitives belong to one loop, and fetch_many_sync() starts a new loop per call
+        loop = asyncio.get_running_loop()
+        if self._changed_loop is not loop:
+            self._changed = asyncio.Event()
+            self._changed_loop = loop
+        return self._changed
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+
+    async def acquire(self, cost: float = 1.0) -> float:
+        """Reserve `cost` points, waiting for room if needed. Pass the result to release()."""
+        while True:
+            self._leak()
+            limit = self.capacity * self.high_water
+            used = self.level + self.reserved
+            # An empty, idle bucket always admits, so a single oversized query cannot stall forever
+            if used + cost <= limit or used == 0:
+                self.reserved += cost
+                return cost
+
+            wait = (used + cost - limit) / self.leak_rate
+            logger.debug(
+                f"Rate limiter at {self.level:.0f}+{self.reserved:.0f} reserved/{self.capacity:.0f}, "
+                f"waiting up to {wait:.2f}s"
+            )
+            changed = self._changed_event()
+            changed.clear()
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, reservation: float, actual_cost: float = 0.0) -> None:
+        """Replace a reservation from acquire() with the cost the request actually consumed."""
+        self._leak()
+        self.reserved = max(0.0, self.reserved - reservation)
+        self.level += actual_cost
+        self._notify()
+
+    def update_from_throttle_status(self, throttle_status: Dict[str, Any]) -> None:
+        maximum = throttle_status.get("maximumAvailable")
+        available = throttle_status.get("currentlyAvailable")
+        restore_rate = throttle_status.get("restoreRate")
+
+        if maximum:
+            self.capacity = float(maximum)
+        if restore_rate:
+            self.leak_rate = float(restore_rate)
+        if maximum is not None and available is not None:
+            self._leak()
+            self.level = float(maximum) - float(available)
+        self._notify()
+
+    def update_from_header(self, call_limit: Optional[str]) -> None:
+        if not call_limit or "/" not in call_limit:
+            return
+
+        used, maximum = call_limit.split("/", 1)
+        try:
+            used, maximum = float(used), float(maximum)
+        except ValueError:
+            logger.warning(f"Unparseable API call limit header: {call_limit}")
+            return
+
+        self._leak()
+        self.capacity = maximum
+        self.level = used
+        self._notify()
@@ -0,0 +1,36 @@
+import logging
+import logging.config
+from pathlib import Path
+from typing import Optional
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# HTTP/2 internals: their DEBUG output floods the log, and hpack's prints request headers
+# (including X-Shopify-Access-Token) in plain text
+QUIET_LOGGERS = ("hpack", "h2", "httpcore")
+
+_configured = False
+
+
+def configure_logging(level: int = logging.INFO, log_file: Optional[Path] = None) -> None:
+    """Configure root logging (console, plus a file when given). Only the first call has effect."""
+    global _configured
+    if _configured:
+        return
+
+    handlers = {
+        "console": {"class": "logging.StreamHandler", "formatter": "default"},
+    }
+    if log_file is not None:
+        Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+        handlers["file"] = {"class": "logging.FileHandler", "formatter": "default", "filename": str(log_file)}
+
+    logging.config.dictConfig({
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {"default": {"format": LOG_FORMAT}},
+        "handlers": handlers,
+        "loggers": {name: {"level": logging.WARNING} for name in QUIET_LOGGERS},
+        "root": {"level": level, "handlers": list(handlers)},
+    })
+    _configured = True
@@ -0,0 +1,237 @@
+import time
+import asyncio
+import logging
+import orjson
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from google.cloud import storage
+from shopify.graphql import ShopifyGraphQL
+from shopify.transform import ShopifyTransform
+from shopify.utils import save_to_json, stream_csv_to_gcs, upload_to_gcs, download_from_gcs_if_changed
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = "club21"
+ORDER_DETAILS_CONCURRENCY = 8  # Max in-flight order_details requests
+ORDER_DETAILS_BATCH_SIZE = 20  # Max orders per aliased order_details request
+ORDER_SHARDS = 8  # Id-range shards when catching up from a checkpoint
+CHECKPOINT_FRESH_SECONDS = 60  # A local checkpoint this recent is trusted without a download
+
+# ✅ Keep last_order.json inside Club21OrderFeed/checkpoints/
+CHECKPOINT_DIR = Path(__file__).resolve().parent.parent / "checkpoints"
+LAST_ORDER_FILE = CHECKPOINT_DIR / "last_order.json"
+
+_UTC = timezone.utc
+_SGT = timezone(timedelta(hours=8))  # Feed filenames use Singapore time
+
+
+def load_latest_order(
+    order_cache_path: Path = LAST_ORDER_FILE,
+    known_generation: Optional[int] = None,
+    client: Optional[storage.Client] = None,
+) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Return (latest order id, checkpoint blob generation), generation being None when unknown.
+    The GCS download is skipped when the local checkpoint is fresh and its generation is
+    known, or when the blob generation still equals `known_generation`.
+    """
+    generation = known_generation
+    checkpoint_age = time.time() - order_cache_path.stat().st_mtime if order_cache_path.exists() else None
+    if known_generation is not None and checkpoint_age is not None and checkpoint_age < CHECKPOINT_FRESH_SECONDS:
+        logger.info(f"Local checkpoint written {checkpoint_age:.0f}s ago, skipping download")
+    else:
+        try:
+            generation = download_from_gcs_if_changed(
+                bucket_name=BUCKET_NAME,
+                source_blob_name=f"LatestOrder/{order_cache_path.name}",
+                destination_file_name=str(order_cache_path),
+                generation=known_generation,
+                client=client,
+            )
+        except Exception as e:
+            logger.error(f"Error downloading latest order file: {e}")
+            generation = None
+
+    if order_cache_path.exists():
+        try:
+            with open(order_cache_path, "rb") as file:
+                data = orjson.loads(file.read())
+                latest_id = data["id"].split("/")[-1]
+                logger.info(f"Latest order ID exists: {latest_id}")
+                return latest_id, generation
+        except (orjson.JSONDecodeError, KeyError) as e:
+            logger.warning(f"Error reading latest order file: {e}")
+    return None, generation
+
+
+def build_query_filter(
+    latest_order_id: Optional[str] = None,
+    lookback: timedelta = timedelta(days=1),
+    fulfillment_status: Optional[str] = "unfulfilled",
+) -> str:
+    """Build Shopify query filter from latest order ID or fallback time window, plus fulfillment status."""
+    if latest_order_id:
+        base = f"id:>{latest_order_id}"
+    else:
+        default_datetime = datetime.now(_UTC) - lookback
+        datetime_utc = default_datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+        base = f"created_at:>'{datetime_utc}'"
+
+    if fulfillment_status:
+        return f"({base}) AND fulfillment_status:{fulfillment_status}"
+    return base
+
+
+def order_number(order: Dict[str, Any]) -> int:
+    return int(order["id"].split("/")[-1])
+
+
+async def fetch_order_pages(
+    pipeline: ShopifyGraphQL,
+    query_filter: str,
+    max_pages: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], bool]:
+    """Page through orders matching `query_filter`. Returns (orders, whether more pages remain)."""
+    orders = []
+    variables = {
+        "first": 250,
+        "after": None,
+        "query": query_filter,
+    }
+
+    # Pacing is handled by the pipeline's leaky-bucket limiter
+    pages = 0
+    while True:
+        response = await pipeline.fetch_async(query="orders", variables=variables)
+        data = response["data"]["orders"]
+        orders.extend(data.get("nodes", []))
+        pages += 1
+
+        page_info = data.get("pageInfo", {})
+        if not page_info.get("hasNextPage"):
+            return orders, False
+        if max_pages is not None and pages >= max_pages:
+            return orders, True
+
+        variables["after"] = page_info.get("endCursor")
+        logger.info(f"Fetching next page of orders ({query_filter})...")
+
+
+async def fetch_newest_order_id(pipeline: ShopifyGraphQL) -> Optional[int]:
+    response = await pipeline.fetch_async(query="newest_order")
+    nodes = response["data"]["orders"]["nodes"]
+    return order_number(nodes[0]) if nodes else None
+
+
+async def fetch_all_orders_parallel(
+    pipeline: ShopifyGraphQL,
+    min_id: int,
+    max_id: int,
+    shards: int = ORDER_SHARDS,
+    fulfillment_status: str = "unfulfilled",
+) -> List[Dict[str, Any]]:
+    """
+    Split the id range (min_id, max_id] into disjoint shards and paginate them concurrently.
+    Cursor pagination is serial, but id-range filters are independent of each other.
+    """
+    min_id, max_id = int(min_id), int(max_id)
+    step = max(1, -(-(max_id - min_id) // shards))
+    bounds = [(lo, min(lo + step, max_id)) for lo in range(min_id, max_id, step)]
+
+    shard_orders = await asyncio.gather(*[
+        fetch_order_pages(pipeline, f"id:>{lo} AND id:<={hi} AND fulfillment_status:{fulfillment_status}")
+        for lo, hi in bounds
+    ])
+    return [order for shard, _ in shard_orders for order in shard]
+
+
+async def fetch_new_orders(
+    pipeline: ShopifyGraphQL,
+    latest_order_id: Optional[str] = None,
+    lookback: timedelta = timedelta(days=1),
+) -> List[Dict[str, Any]]:
+    """
+    Fetch every unfulfilled order after the checkpoint, sorted by id so orders[-1] is the newest.
+    A normal poll fits in one page; only a backlog larger than that is split into id-range shards.
+    """
+    if not latest_order_id:
+        orders, _ = await fetch_order_pages(pipeline, build_query_filter(lookback=lookback))
+    else:
+        orders, has_more = await fetch_order_pages(pipeline, build_query_filter(latest_order_id), max_pages=1)
+        if has_more:
+            # Pages come in ascending id order, so the rest of the backlog lies above this page
+            last_order_id = max(map(order_number, orders))
+            newest_order_id = await fetch_newest_order_id(pipeline)
+            if newest_order_id and newest_order_id > last_order_id:
+                orders += await fetch_all_orders_parallel(pipeline, last_order_id, newest_order_id)
+
+    orders.sort(key=order_number)
+    return orders
+
+
+async def run_pipeline(
+    pipeline: ShopifyGraphQL,
+    gcs_client: Optional[storage.Client] = None,
+    checkpoint_generation: Optional[int] = None,
+    lookback: timedelta = timedelta(days=1),
+    save_order_json: bool = False,
+) -> Optional[int]:
+    """
+    Fetch new unfulfilled orders, stream the feed CSV to GCS, then advance the checkpoint.
+    Returns the checkpoint blob generation to pass to the next run (None when unknown).
+    Blocking GCS and transform work runs in worker threads so an event loop stays responsive.
+    """
+    CHECKPOINT_DIR.mkdir(exist_ok=True)
+    latest_order_id, generation = await asyncio.to_thread(
+        load_latest_order, LAST_ORDER_FILE, checkpoint_generation, gcs_client
+    )
+
+    orders = await fetch_new_orders(pipeline, latest_order_id, lookback)
+    if not orders:
+        logger.info("No new orders to process.")
+        return generation
+
+    for order in orders:
+        logger.info(f"Processing Order ID: {order['id']}, Name: {order['name']}")
+
+    # ⚡ Fetch order details in aliased batches, concurrently over one HTTP/2 connection
+    order_responses = await pipeline.fetch_order_details(
+        [order["id"] for order in orders],
+        max_batch_size=ORDER_DETAILS_BATCH_SIZE,
+        concurrency=ORDER_DETAILS_CONCURRENCY,
+    )
+
+    # 🐞 Responses stay in memory; keep a JSON copy only when debugging
+    if save_order_json:
+        for order, order_response in zip(orders, order_responses):
+            local_json_path = pipeline.save_response(order_response, f"order_{order_number(order)}.json")
+            logger.info(f"✅ JSON saved locally: {local_json_path}")
+
+    now = datetime.now(_SGT).strftime("%Y%m%d_%H%M%S")
+    table = await asyncio.to_thread(ShopifyTransform().to_table, responses=order_responses)
+
+    # 📤 Stream CSV straight to GCS, no local copy
+    destination_file = f"S21_SH_ORDERS_{now}.csv"
+    destination_path = await asyncio.to_thread(
+        stream_csv_to_gcs,
+        table,
+        bucket_name=BUCKET_NAME,
+        destination_blob_name=f"OrderFeed/{destination_file}",
+        client=gcs_client,
+    )
+    logger.info(f"📤 File uploaded to GCS: {destination_path}")
+
+    # ✅ Advance the checkpoint only once the feed is uploaded; don't clobber
+    # a checkpoint another run wrote since we read it
+    save_to_json(orders[-1], LAST_ORDER_FILE)
+    generation = await asyncio.to_thread(
+        upload_to_gcs,
+        bucket_name=BUCKET_NAME,
+        source_file_name=str(LAST_ORDER_FILE),
+        destination_blob_name=f"LatestOrder/{LAST_ORDER_FILE.name}",
+        client=gcs_client,
+        if_generation_match=generation,
+    )
+    logger.info(f"Latest order saved: {LAST_ORDER_FILE}")
+    return generation
@@ -1,9 +1,12 @@
 import os
-import json
+import orjson
 import logging
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, Iterator, List
 from shopify.graphql import ShopifyGraphQL
 
 logger = logging.getLogger(__name__)
@@ -24,136 +27,230 @@ REQUIRED_COLS = {
     "gender": "Gender",
     "image_url": "Image URL",
 }
+FEED_COLS = tuple(REQUIRED_COLS)
+FEED_HEADERS = tuple(REQUIRED_COLS.values())
 
+# Flattening costs ~50us per order file; below this many files, pool start-up and IPC cost more
+PARALLEL_MIN_FILES = 2000
 
-def get_gender(tags: list) -> str:
-    if not tags:
-        return "Unisex"
-    tags_lower = " ".join(tags).lower()
-    female_terms = any(term in tags_lower for term in ["women", "woman", "female", "girls"])
-    male_terms = any(term in tags_lower for term in ["men", "man", "male", "boys"])
-    if female_terms and male_terms:
-        return "Unisex"
-    elif female_terms:
-        return "Female"
-    elif male_terms:
-        return "Male"
-    else:
-        return "Unisex"
+
+# Leading word boundary only: "women"/"female" no longer count as "men"/"male",
+# while prefixes such as "Menswear" and "Womenswear" still match. RE2 syntax for
+# Arrow's match_substring_regex, whose \b is ASCII-only; matched case-insensitively.
+FEMALE_PATTERN = r"\b(?:women|woman|female|girls)"
+MALE_PATTERN = r"\b(?:men|man|male|boys)"
+
+
+PRICE_COLS = ("net_price_sgd", "net_price_myr", "item_tax_sgd", "item_tax_myr")
+
+
+def _new_columns() -> Dict[str, List[Any]]:
+    return {key: [] for key in FEED_COLS}
+
+
+def _feed_arrays(columns: Dict[str, List[Any]]) -> Dict[str, pa.Array]:
+    """
+    Type the raw columns collected by _flatten_orders() with vectorized Arrow kernels:
+    amount strings become floats (missing amounts 0.0) and joined tag text becomes
+    a Gender value: Female or Male when only that pattern matches, otherwise Unisex.
+    """
+    arrays = {key: pa.array(values) for key, values in columns.items() if key not in PRICE_COLS and key != "gender"}
+
+    for key in PRICE_COLS:
+        arrays[key] = pc.cast(pa.array(columns[key], pa.string()), pa.float64()).fill_null(0.0)
+
+    # The same products recur across line items: classify each distinct tag text once
+    tags = pa.array(columns["gender"], pa.string()).dictionary_encode()
+    female = pc.match_substring_regex(tags.dictionary, FEMALE_PATTERN, ignore_case=True)
+    male = pc.match_substring_regex(tags.dictionary, MALE_PATTERN, ignore_case=True)
+    genders = pc.if_else(
+        pc.and_not(female, male),
+        pa.scalar("Female"),
+        pc.if_else(pc.and_not(male, female), pa.scalar("Male"), pa.scalar("Unisex")),
+    )
+    arrays["gender"] = pc.take(genders, tags.indices).fill_null("Unisex")
+
+    return {key: arrays[key] for key in FEED_COLS}
+
+
+def _flatten_orders(orders: Iterable[Dict[str, Any]], columns: Dict[str, List[Any]]) -> None:
+    """Append the line items of order_details `order`s to the per-column lists in `columns`."""
+    # Bind the per-column appends and the debug check once per run, not per line item
+    append_sg_sku = columns["sg_sku"].append
+    append_quantity = columns["quantity"].append
+    append_discount_code = columns["discount_code"].append
+    append_brand = columns["brand"].append
+    append_category = columns["category"].append
+    append_net_price_sgd = columns["net_price_sgd"].append
+    append_net_price_myr = columns["net_price_myr"].append
+    append_item_tax_sgd = columns["item_tax_sgd"].append
+    append_item_tax_myr = columns["item_tax_myr"].append
+    append_shipping_country = columns["shipping_country"].append
+    append_order_name = columns["order_name"].append
+    append_quantity_ready = columns["quantity_ready"].append
+    append_gender = columns["gender"].append
+    append_image_url = columns["image_url"].append
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    for order in orders:
+        # ✅ Order-level info
+        order_name = order.get("name")
+        discount_code = None
+        # Orders without shipping (e.g. digital goods) come back with shippingAddress: null
+        shipping_country = (order.get("shippingAddress") or {}).get("country")
+
+        # ✅ Extract discount codes
+        discounts = (order.get("discountApplications") or {}).get("nodes")
+        if discounts:
+            codes = [d.get("code") for d in discounts if "code" in d]
+            discount_code = ",".join(filter(None, codes)) if codes else None
+
+        # ✅ Loop line items
+        for li in (order.get("lineItems") or {}).get("nodes") or []:
+            variant = li.get("variant") or {}
+            product = variant.get("product") or {}
+
+            image_data = li.get("image") # Corrected path for image data
+            image_url = image_data.get("url") if image_data else None
+
+            if debug and not image_url:
+                logger.debug(f"Image URL not found for line item. Variant data: {variant}")
+
+            sg_sku = variant.get("sku")
+            quantity = li.get("quantity", 0)
+
+            # 🚀 Only append if at least one key column has a value
+            if not (sg_sku or quantity):
+                continue
+
+            # Walk each money set once per line item
+            unit_price = li.get("originalUnitPriceSet") or {}
+            tax_lines = li.get("taxLines")
+            tax_price = (tax_lines[0].get("priceSet") or {}) if tax_lines else None
+            tags = product.get("tags")
+
+            append_sg_sku(sg_sku)
+            append_quantity(quantity)
+            append_discount_code(discount_code)
+            append_brand(product.get("vendor"))
+            append_category(product.get("productType"))
+            # Raw amount strings; parsed to floats in one vectorized pass by _feed_arrays()
+            append_net_price_sgd((unit_price.get("shopMoney") or {}).get("amount"))
+            append_net_price_myr((unit_price.get("presentmentMoney") or {}).get("amount"))
+            append_item_tax_sgd((tax_price.get("shopMoney") or {}).get("amount") if tax_price is not None else None)
+            append_item_tax_myr(
+                (tax_price.get("presentmentMoney") or {}).get("amount") if tax_price is not None else None
+            )
+            append_shipping_country(shipping_country)
+            append_order_name(order_name)
+            append_quantity_ready(li.get("fulfillableQuantity", 0))
+            # Joined tag text; classified by _feed_arrays()
+            append_gender(" ".join(tags) if tags else None)
+            append_image_url(image_url) # Safely extract image URL
+
+
+def _flatten_file(order_file_path: str) -> Dict[str, List[Any]]:
+    # Parse and flatten a single order_*.json file, sequentially or as the process-pool worker
+    columns = _new_columns()
+    logger.info(f"Processing {order_file_path}......")
+    try:
+        with open(order_file_path, "rb") as file:
+            response = orjson.loads(file.read())
+    except FileNotFoundError:
+        logger.warning(f"File {order_file_path} does not exist.")
+        return columns
+    _flatten_orders([response["data"]["order"]], columns)
+    return columns
 
 
 class ShopifyTransform:
     def __init__(self, destination: Path = ShopifyGraphQL.DESTINATION):
         self.destination = destination
 
-    def load_dir(self) -> List:
-        files = self.destination.glob("*.json")
-        return [file.name for file in files if file.is_file()]
+    def load_dir(self) -> Iterator[str]:
+        # Lazily yield order_*.json paths; scandir entries carry their file type, so no extra stat
+        with os.scandir(self.destination) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.startswith("order_") and entry.name.endswith(".json"):
+                    yield entry.path
 
-    def load_json(self, file_path: str) -> Dict[str, Any]:
-        with open(file_path, "r") as file:
-            return json.load(file)
-
-    def flatten(self) -> List[Dict[str, Any]]:
-        rows = []
-        order_files = self.load_dir()
+    def flatten_columns(self, responses: Iterable[Dict[str, Any]] = None) -> Dict[str, List[Any]]:
+        """
+        Flatten order_details responses into one list per REQUIRED_COLS key (line items in order).
+        Price columns hold the raw amount strings and `gender` the joined tags; see _feed_arrays().
+        Reads the JSON files in `destination` when no in-memory responses are given;
+        large directories are parsed across a process pool.
+        """
+        columns = _new_columns()
+        if responses is None:
+            order_files = list(self.load_dir())
+            if len(order_files) >= PARALLEL_MIN_FILES and (os.cpu_count() or 1) > 1:
+                with ProcessPoolExecutor() as executor:
+                    for file_columns in executor.map(_flatten_file, order_files, chunksize=8):
+                        for key, values in file_columns.items():
+                            columns[key].extend(values)
+            else:
+                for file_columns in map(_flatten_file, order_files):
+                    for key, values in file_columns.items():
+                        columns[key].extend(values)
+            return columns
 
-        for order_file in order_files:
-            logger.info(f"Processing {order_file}......")
-            order_file_path = self.destination / order_file
+        _flatten_orders((response["data"]["order"] for response in responses), columns)
+        return columns
 
-            if not os.path.exists(order_file_path):
-                logger.warning(f"File {order_file_path} does not exist.")
-                continue
+    def flatten(self, responses: Iterable[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Flatten order_details responses into line-item row dicts."""
+        return pa.table(_feed_arrays(self.flatten_columns(responses))).to_pylist()
 
-            order = self.load_json(order_file_path)["data"]["order"]
-
-            # ✅ Order-level info
-            order_info = {
-                "order_name": order.get("name"),
-                "discount_code": None,
-                "shipping_country": order.get("shippingAddress", {}).get("country"),
-            }
-
-            # ✅ Extract discount codes
-            if order.get("discountApplications", {}).get("nodes"):
-                discounts = order["discountApplications"]["nodes"]
-                codes = [d.get("code") for d in discounts if "code" in d]
-                order_info["discount_code"] = ",".join(filter(None, codes)) if codes else None
-
-            # ✅ Loop line items
-            for li in order.get("lineItems", {}).get("nodes", []):
-                variant = li.get("variant") or {}
-                product = variant.get("product") or {}
-
-                if variant is None:
-                    logger.debug(f"Variant is None for line item: {li}")
-
-                image_data = li.get("image") # Corrected path for image data
-                image_url = image_data.get("url") if image_data else None
-
-                row = {
-                    **order_info,
-                    "sg_sku": variant.get("sku"),
-                    "quantity": li.get("quantity", 0),
-                    "quantity_ready": li.get("fulfillableQuantity", 0),
-                    "brand": product.get("vendor"),
-                    "category": product.get("productType"),
-                    "gender": get_gender(product.get("tags", [])),
-                    "image_url": image_url, # Safely extract image URL
-                    "net_price_sgd": float(
-                        li.get("originalUnitPriceSet", {})
-                          .get("shopMoney", {})
-                          .get("amount", 0.0)
-                    ),
-                    "net_price_myr": float(
-                        li.get("originalUnitPriceSet", {})
-                          .get("presentmentMoney", {})
-                          .get("amount", 0.0)
-                    ),
-                    "item_tax_sgd": float(
-                        li.get("taxLines", [{}])[0]
-                          .get("priceSet", {})
-                          .get("shopMoney", {})
-                          .get("amount", 0.0)
-                    ) if li.get("taxLines") else 0.0,
-                    "item_tax_myr": float(
-                        li.get("taxLines", [{}])[0]
-                          .get("priceSet", {})
-                          .get("presentmentMoney", {})
-                          .get("amount", 0.0)
-                    ) if li.get("taxLines") else 0.0,
-                }
-
-                if not row["image_url"]:
-                    logger.debug(f"Image URL not found for line item. Variant data: {variant}")
-
-                # 🚀 Only append if at least one key column has a value
-                if any([row.get("sg_sku"), row.get("quantity")]):
-                    rows.append(row)
-
-        return rows
-
-    def to_dataframe(self, rows: List[Dict[str, Any]] = None) -> pd.DataFrame:
-        if rows is None:
-            rows = self.flatten()
-        df = pd.DataFrame(rows)
+    def to_dataframe(
+        self,
+        rows: List[Dict[str, Any]] = None,
+        columns: Dict[str, List[Any]] = None,
+    ) -> pd.DataFrame:
+        if rows is not None:
+            df = pd.DataFrame(rows)
+        else:
+            if columns is None:
+                columns = self.flatten_columns()
+            df = pa.table(_feed_arrays(columns)).to_pandas()
 
         # ✅ Ensure all required columns exist
-        for col in REQUIRED_COLS.keys():
+        for col in FEED_COLS:
             if col not in df.columns:
                 df[col] = None
 
         # 🚀 Drop fully empty rows
         df = df.dropna(how="all")
 
-        return df[REQUIRED_COLS.keys()].rename(columns=REQUIRED_COLS)
+        # Selecting returns a new frame, so its labels can be replaced in place of a rename() pass
+        df = df[list(FEED_COLS)]
+        df.columns = FEED_HEADERS
+        return df
+
+    def to_table(
+        self,
+        rows: List[Dict[str, Any]] = None,
+        responses: Iterable[Dict[str, Any]] = None,
+    ) -> pa.Table:
+        """
+        Build the feed columns with pyarrow, skipping the pandas frame.
+        Same columns, names and order as to_dataframe().
+        """
+        if rows is not None:
+            return pa.table([[row.get(key) for row in rows] for key in FEED_COLS], names=FEED_HEADERS)
+
+        arrays = _feed_arrays(self.flatten_columns(responses))
+        return pa.table([arrays[key] for key in FEED_COLS], names=FEED_HEADERS)
 
-    def post_transform(self, rows: List[Dict[str, Any]] = None) -> pd.DataFrame:
+    def post_transform(
+        self,
+        rows: List[Dict[str, Any]] = None,
+        responses: Iterable[Dict[str, Any]] = None,
+    ) -> pd.DataFrame:
         """
-        Compatibility wrapper for main.py.
-        Runs flatten() and to_dataframe() just like before.
+        Build the feed DataFrame from `rows`, or else from `responses` (order files in
+        `destination` when neither is given) via flatten_columns() and to_dataframe().
         """
-        if rows is None:
-            rows = self.flatten()
-        return self.to_dataframe(rows)
+        if rows is not None:
+            return self.to_dataframe(rows)
+        return self.to_dataframe(columns=self.flatten_columns(responses))
@@ -1,7 +1,15 @@
+import io
+import gzip
 import os
-import json
+import csv
 import shutil
 import logging
+import orjson
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+from functools import lru_cache
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 
 logger = logging.getLogger(__name__)
@@ -31,40 +39,18 @@ def load_env(env_file=".env"):
 
 
 def save_to_json(data, filename):
-    with open(filename, "w") as file:
-        json.dump(data, file, indent=4)
+    with open(filename, "wb") as file:
+        file.write(orjson.dumps(data))
         
 
-def post_csv_transform(filename):
-    # Read file in binary then try common decodings to avoid platform-specific
-    # codec errors (Windows default cp1252). Write back as UTF-8.
-    with open(filename, "rb") as bf:
-        raw = bf.read()
-
-    text = None
-    decodings = ["utf-8", "utf-8-sig", "latin-1", "cp1252"]
-    for enc in decodings:
-        try:
-            text = raw.decode(enc)
-            break
-        except Exception:
-            continue
-
-    if text is None:
-        # Last resort: replace invalid characters
-        text = raw.decode("utf-8", errors="replace")
-
+def clean_csv_text(text):
     # Cleanup duplicated quotes pattern that sometimes appears
     text = text.replace('""""""', '""')
 
     # Remove any completely empty lines to prevent extra blank rows
     lines = text.splitlines()
     non_empty_lines = [line for line in lines if line.strip()]
-    text = '\n'.join(non_empty_lines)
-
-    # Write normalized UTF-8 file
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(text)
+    return '\n'.join(non_empty_lines)
         
 
 def remove_dir(dir_path):
@@ -75,19 +61,127 @@ def remove_dir(dir_path):
         logger.info(f"Directory does not exist: {dir_path}")
         
 
-def upload_to_gcs(bucket_name, source_file_name, destination_blob_name):
-    client = storage.Client()
+@lru_cache(maxsize=1)
+def get_gcs_client():
+    # One client (auth token + HTTP connection pool) per process, shared by the entry points and
+    # by helpers called without their own. A failed construction isn't cached, so it is retried.
+    return storage.Client()
+
+
+def upload_to_gcs(bucket_name, source_file_name, destination_blob_name, client=None, if_generation_match=None):
+    client = client or get_gcs_client()
     bucket = client.bucket(bucket_name=bucket_name)
     blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)
+    blob.upload_from_filename(source_file_name, if_generation_match=if_generation_match)
     logger.info(f"File {source_file_name} uploaded to {destination_blob_name} in bucket {bucket_name}.")
+    return blob.generation
+
+
+def _float_csv_text(column):
+    # Format floats the way pandas does (Python's repr). Arrow prints integral values like
+    # 1e10 as "1e+10", so those are reprinted from int64; repr only uses exponent notation
+    # outside [1e-4, 1e16), and chunks with such values are left to the pandas fallback.
+    column = pc.if_else(pc.is_nan(column), pa.scalar(None, column.type), column)
+    text = pc.cast(column, pa.string())
+    magnitude = pc.abs(column)
+    integral = pc.equal(column, pc.floor(column))
+    exponent = pc.match_substring(text, "e")
+    unsupported = pc.or_(
+        pc.or_(pc.greater_equal(magnitude, 1e16), pc.and_(pc.not_equal(column, 0), pc.less(magnitude, 1e-4))),
+        pc.and_(exponent, pc.invert(pc.and_(integral, pc.less(magnitude, 2**53)))),
+    )
+    if pc.any(unsupported).as_py():
+        raise pa.ArrowInvalid("float values need exponent notation")
+
+    digits = pc.cast(column, pa.int64(), safe=False)
+    text = pc.if_else(exponent, pc.cast(digits, pa.string()), text)
+    return pc.if_else(integral, pc.binary_join_element_wise(text, ".0", ""), text)
+
+
+def to_csv_text(data, header=True):
+    # pyarrow's C++ writer is much faster than pandas' row formatter. Floats and the
+    # header are normalized so the output matches to_csv(quoting=csv.QUOTE_MINIMAL);
+    # chunks holding values that would need quoting go through pandas instead.
+    # `data` is a DataFrame or a pyarrow Table.
+    try:
+        table = data if isinstance(data, pa.Table) else pa.Table.from_pandas(data, preserve_index=False)
+
+        columns = []
+        for column in table.columns:
+            if pa.types.is_integer(column.type) and column.null_count:
+                column = pc.cast(column, pa.float64())  # As to_pandas() does for ints with nulls
+            if pa.types.is_floating(column.type):
+                columns.append(_float_csv_text(column))
+            else:
+                columns.append(column)
+        table = pa.table(columns, names=table.column_names)
+
+        buffer = pa.BufferOutputStream()
+        pacsv.write_csv(
+            table,
+            buffer,
+            write_options=pacsv.WriteOptions(include_header=False, quoting_style="none", batch_size=10_000),
+        )
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        logger.debug(f"Falling back to pandas CSV writer: {e}")
+        dataframe = data.to_pandas() if isinstance(data, pa.Table) else data
+        return dataframe.to_csv(index=False, header=header, quoting=csv.QUOTE_MINIMAL)
+
+    sink = io.StringIO()
+    if header:
+        csv.writer(sink, quoting=csv.QUOTE_MINIMAL, lineterminator="\n").writerow(table.column_names)
+    sink.write(buffer.getvalue().to_pybytes().decode("utf-8"))
+    return sink.getvalue()
+
+
+def stream_csv_to_gcs(data, bucket_name, destination_blob_name, chunksize=10_000, client=None):
+    # Serialize the DataFrame or pyarrow Table in row chunks straight into a resumable upload,
+    # applying clean_csv_text() to each chunk without a local file.
+    # The body is gzipped with Content-Encoding: gzip; GCS transcodes it back
+    # to plain CSV for readers that don't accept gzip.
+    client = client or get_gcs_client()
+    bucket = client.bucket(bucket_name=bucket_name)
+    blob = bucket.blob(destination_blob_name)
+    blob.content_encoding = "gzip"
+    with (
+        blob.open("wb", content_type="text/csv") as raw,
+        gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as compressed,
+        io.TextIOWrapper(compressed, encoding="utf-8", newline="") as f,
+    ):
+        for start in range(0, max(len(data), 1), chunksize):
+            rows = data.slice(start, chunksize) if isinstance(data, pa.Table) else data.iloc[start:start + chunksize]
+            chunk = to_csv_text(rows, header=start == 0)
+            if start:
+                f.write("\n")
+            f.write(clean_csv_text(chunk))
+    logger.info(f"CSV streamed to {destination_blob_name} in bucket {bucket_name}.")
     return destination_blob_name
 
 
-def download_from_gcs(bucket_name, source_blob_name, destination_file_name):
-    client = storage.Client()
+def download_from_gcs(bucket_name, source_blob_name, destination_file_name, client=None):
+    client = client or get_gcs_client()
     bucket = client.bucket(bucket_name)
     blob = bucket.blob(source_blob_name)
     blob.download_to_filename(destination_file_name)
     logger.info(f"Blob {source_blob_name} downloaded to {destination_file_name}.")
     return destination_file_name
+
+
+def download_from_gcs_if_changed(bucket_name, source_blob_name, destination_file_name, generation=None, client=None):
+    # Metadata-only reload first; the object itself is fetched only when its generation moved.
+    # Returns 0 for a missing blob, which as an if_generation_match means "only if absent".
+    client = client or get_gcs_client()
+    bucket = client.bucket(bucket_name)
+    blob = bucket.blob(source_blob_name)
+    try:
+        blob.reload()
+    except NotFound:
+        logger.info(f"Blob {source_blob_name} does not exist yet.")
+        return 0
+    if generation is not None and blob.generation == generation:
+        logger.info(f"Blob {source_blob_name} unchanged (generation {generation}), skipping download.")
+        return blob.generation
+
+    blob.download_to_filename(destination_file_name, if_generation_match=blob.generation)
+    logger.info(f"Blob {source_blob_name} downloaded to {destination_file_name}.")
+    return blob.generation